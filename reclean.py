@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
-import json
+import sys
 import argparse
 import subprocess
-import tempfile
-import pathlib
+import shlex
 
-default_prepdir = tempfile.mkdtemp()
+# the master connection is kept alive for a minute after use, so subsequent invocations
+# can reuse it; the socket lives in ~/.ssh to keep it out of reach of other users
+ssh_socketfile = '~/.ssh/remarkable-%r@%h:%p'
+ssh_options = f'-o ConnectTimeout=1 -o ControlMaster=auto -o ControlPersist=60 -o ControlPath={ssh_socketfile}'
 
-ssh_socketfile = '/tmp/remarkable-push.socket'
+# number of documents removed per remote rm invocation, keeps the command line well below ARG_MAX
+rm_batchsize = 100
 
 parser = argparse.ArgumentParser(description='Clean deleted files from your reMarkable')
 parser.add_argument('-r', '--remote-address', action='store', default='10.11.99.1', dest='ssh_destination', metavar='<IP or hostname>', help='remote address of the reMarkable')
@@ -16,112 +19,76 @@ parser.add_argument('--dry-run', dest='dryrun', action='store_true', default=Fal
 
 args = parser.parse_args()
 
+ssh_command = ['ssh'] + ssh_options.split() + [f'root@{args.ssh_destination}']
 
-def get_metadata_by_uuid(u):
+
+def ssh(cmd, dry=False):
 	"""
-	retrieves metadata for a given document identified by its uuid
+	runs a command on the reMarkable and returns its output;
+	on a dry run the ssh invocation is only printed
 	"""
-	raw_metadata = subprocess.getoutput(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "cat ~/.local/share/remarkable/xochitl/{u}.metadata"')
-	try:
-		metadata = json.loads(raw_metadata)
-		return metadata
-
-	except json.decoder.JSONDecodeError:
-		return None
-
-
-ssh_connection = None
-try:
-	ssh_connection = subprocess.Popen(f'ssh -o ConnectTimeout=1 -M -N -q -S {ssh_socketfile} root@{args.ssh_destination}', shell=True)
+	argv = ssh_command + [cmd]
+	if dry:
+		print(' '.join(shlex.quote(a) for a in argv))
+		return ''
 
-	# quickly check if we actually have a functional ssh connection (might not be the case right after an update)
-	checkmsg = subprocess.getoutput(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "/bin/true"')
-	if checkmsg != "":
-		print("ssh connection does not work, verify that you can manually ssh into your reMarkable. ssh itself commented the situation with:")
-		print(checkmsg)
-		ssh_connection.terminate()
-		sys.exit(255)
+	return subprocess.run(argv, stdout=subprocess.PIPE, universal_newlines=True).stdout
 
 
-	#################################
-	#
-	#   Clean up deleted files
-	#
-	#################################
+# quickly check if we actually have a functional ssh connection (might not be the case right after an update);
+# this call may start the persistent master connection, and older ssh clients leave that one attached to
+# our stderr, so ssh gets to talk to the terminal directly instead of through a pipe we'd wait on
+if subprocess.run(ssh_command + ['/bin/true']).returncode != 0:
+	print("ssh connection does not work, verify that you can manually ssh into your reMarkable. ssh itself commented the situation above.")
+	sys.exit(255)
 
-	document_metadata = subprocess.getoutput(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "ls -1 ~/.local/share/remarkable/xochitl/*.metadata"')
-	metadata_uuids = set([pathlib.Path(d).stem for d in document_metadata.split('\n')])
 
-	deleted_uuids = []
-	limit = 10
-	for i, u in enumerate(metadata_uuids):
-		if i/len(metadata_uuids)*100 > limit:
-			print(f'checking for deleted files - {limit}% done')
-			limit += 10
+#################################
+#
+#   Clean up deleted files
+#
+#################################
 
+# let the device list all files whose stem has no metadata file (this includes tombstones) in the
+# background while it looks for deleted documents; the listing has to be complete before anything
+# gets removed though, otherwise leftovers of a document being deleted would show up as orphans
+orphan_listing = subprocess.Popen(ssh_command + ['cd ~/.local/share/remarkable/xochitl && for f in *; do [ -e "$f" ] && [ ! -e "${f%%.*}.metadata" ] && echo "$f"; done'], stdout=subprocess.PIPE, universal_newlines=True)
 
-		md = get_metadata_by_uuid(u)
-		if md is not None and md['deleted']:
-				deleted_uuids.append(u)
+# deleted documents are only recognizable by the flag in their metadata, let the device find them for us
+# so we neither have to transfer nor parse the metadata of all the other documents
+deleted_ls = ssh('grep -lE \'"deleted": *true\' ~/.local/share/remarkable/xochitl/*.metadata 2>/dev/null')
+deleted_uuids = [p.rsplit('/', 1)[-1].rsplit('.', 1)[0] for p in deleted_ls.split('\n') if p != '']
 
-	print(f'checking for deleted files - {limit}% done')
-
-	if len(deleted_uuids) == 0:
-		print('No deleted files found.')
-	else:
-
-		decision = input(f'Clean up {len(deleted_uuids)} deleted files? [Y/n]')
-		if decision in ['', 'y', 'Y']:
-			for u in deleted_uuids:
-				cmd = f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "rm -r ~/.local/share/remarkable/xochitl/{u}*"'
-				if args.dryrun:
-					print(cmd)
-				else:
-					subprocess.getoutput(cmd)
+orphan_ls, _ = orphan_listing.communicate()
+orphaned_files = [f for f in orphan_ls.split('\n') if f != '']
 
+if len(deleted_uuids) == 0:
+	print('No deleted files found.')
+else:
 
+	decision = input(f'Clean up {len(deleted_uuids)} deleted files? [Y/n]')
+	if decision in ['', 'y', 'Y']:
+		for i in range(0, len(deleted_uuids), rm_batchsize):
+			patterns = ' '.join(f'{u}*' for u in deleted_uuids[i:i+rm_batchsize])
+			ssh(f'cd ~/.local/share/remarkable/xochitl && rm -r {patterns}', dry=args.dryrun)
 
-	#################################
-	#
-	#   Clean up orphaned files
-	#
-	#################################
 
-	all_document_ls = subprocess.getoutput(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "ls -1 ~/.local/share/remarkable/xochitl"')
-	all_document_files = [pathlib.Path(p) for p in all_document_ls.split('\n')]
-	all_uuids = set([d.stem for d in all_document_files])
 
-	orphaned_file_stems = all_uuids.difference(metadata_uuids)
+#################################
+#
+#   Clean up orphaned files
+#
+#################################
 
-	if len(orphaned_file_stems) > 0:
-		decision = input(f"Clear {len(orphaned_file_stems)} orphaned files that don't have metadata associated with them? [Y/n]")
-	else:
-		decision = 'n'
+if len(orphaned_files) > 0:
+	decision = input(f"Clear {len(orphaned_files)} orphaned files that don't have metadata associated with them? [Y/n]")
+else:
+	decision = 'n'
 
-	if decision in ['', 'y', 'Y']:
+if decision in ['', 'y', 'Y']:
 
-		# now let's make sure all our orphaned nodes are actually unambiguous
-		orphan_deletion_candidates = []
-		for ofs in orphaned_file_stems:
-			# get all files that would match our ofs* deletion pattern later, and their stems
-			deletion_candidates = [d for d in all_document_files if d.name.startswith(ofs)]
-			orphan_stems = set([d.stem for d in deletion_candidates])
-
-			# if we didn't mismatch anything, i.e. having a file with stem 'a' and matching all uuids 'a*',
-			# we only have one orphan stem in the set. Otherwise we have an ambiguity and leave fixing to the user.
-			if len(orphan_stems) > 1:
-				print(f'~/.local/share/remarkable/xochitl/{ofs}* has no metadata, but matches more than one document or file. Ignoring this, you will have to check this manually.')
-			else:
-				orphan_deletion_candidates.append(ofs)
-
-
-		for of in orphan_deletion_candidates:
-			cmd = f'ssh -S {ssh_socketfile} root@{args.ssh_destination} \'rm "/home/root/.local/share/remarkable/xochitl/{of}"*\''
-			if args.dryrun:
-				print(cmd)
-			else:
-				subprocess.call(cmd, shell=True)
-
-finally:
-	if ssh_connection is not None:
-		ssh_connection.terminate()
+	# orphans are removed by their exact name rather than by a stem pattern,
+	# so there is no risk of accidentally matching another document
+	for i in range(0, len(orphaned_files), rm_batchsize):
+		names = ' '.join(shlex.quote(of) for of in orphaned_files[i:i+rm_batchsize])
+		ssh(f'cd ~/.local/share/remarkable/xochitl && rm -r {names}', dry=args.dryrun)
@@ -4,7 +4,7 @@
 resync_cmd = 'resync.py'
 
 
-import sys, os, subprocess, pathlib, tempfile, shutil, argparse, json
+import sys, os, subprocess, pathlib, tempfile, shutil, argparse, json, tarfile
 
 parser = argparse.ArgumentParser(description='Relay documents over your reMarkable for signing')
 parser.add_argument('-r', '--remote-address', action='store', default='10.11.99.1', dest='ssh_destination', metavar='<IP or hostname>', help='remote address of the reMarkable')
@@ -13,15 +13,17 @@ args = parser.parse_args()
 
 
 prepdir = pathlib.Path(tempfile.mkdtemp())
-ssh_socketfile = '/tmp/remarkable-push.socket'
-ssh_connection = subprocess.Popen(f'ssh -o ConnectTimeout=1 -M -N -q -S {ssh_socketfile} root@{args.ssh_destination}', shell=True)
-
-# quickly check if we actually have a functional ssh connection (might not be the case right after an update)
-checkmsg = subprocess.getoutput(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "/bin/true"')
-if checkmsg != "":
-	print("ssh connection does not work, verify that you can manually ssh into your reMarkable. ssh itself commented the situation with:")
-	print(checkmsg)
-	ssh_connection.terminate()
+# the master connection is kept alive for a minute after use, so subsequent invocations
+# can reuse it; the socket lives in ~/.ssh to keep it out of reach of other users
+ssh_socketfile = '~/.ssh/remarkable-%r@%h:%p'
+ssh_options = f'-o ConnectTimeout=1 -o ControlMaster=auto -o ControlPersist=60 -o ControlPath={ssh_socketfile}'
+ssh_command = ['ssh'] + ssh_options.split() + [f'root@{args.ssh_destination}']
+
+# quickly check if we actually have a functional ssh connection (might not be the case right after an update);
+# this call may start the persistent master connection, and older ssh clients leave that one attached to
+# our stderr, so ssh gets to talk to the terminal directly instead of through a pipe we'd wait on
+if subprocess.run(ssh_command + ['/bin/true']).returncode != 0:
+	print("ssh connection does not work, verify that you can manually ssh into your reMarkable. ssh itself commented the situation above.")
 	sys.exit(255)
 
 
@@ -61,51 +63,65 @@ shutil.rmtree(prepdir)
 #######################################################################
 
 
-def get_uuid_by_visibleName(name):
+def retrieve_metadata():
 	"""
-	retrieves uuid for all given documents that have the given name set as visibleName
+	retrieves the metadata of all documents on the device as a single tar stream,
+	returns a dict mapping each uuid to its metadata
 	"""
-	#pattern = f'"visibleName": "{name}"'
-	cmd = f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "grep -lF \'\\"visibleName\\": \\"{name}\\"\' .local/share/remarkable/xochitl/*.metadata"'
-	res = subprocess.getoutput(cmd)
+	p = subprocess.Popen(ssh_command + ['cd ~/.local/share/remarkable/xochitl && tar cf - *.metadata 2>/dev/null'], stdout=subprocess.PIPE)
+
+	metadata_by_uuid = {}
+	try:
+		with tarfile.open(fileobj=p.stdout, mode='r|') as tar:
+			for member in tar:
+				if not member.isfile() or not member.name.endswith('.metadata'):
+					continue
+
+				# every file arrives with its name, so a broken one can simply be skipped
+				try:
+					metadata_by_uuid[member.name[:-len('.metadata')]] = json.loads(tar.extractfile(member).read().decode('utf-8'))
+				except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+					continue
+
+	except tarfile.ReadError:
+		# empty stream, i.e. there are no documents on the device at all
+		pass
 
-	uuid_candidates = []
-	if res != '':
-		for result in res.split('\n'):
-			try:
-				# hard pattern matching to provoke a mismatch-exception on the first number mismatch
-				_, _, _, _, filename = result.split('/')
-			except ValueError:
-				continue
+	p.communicate()
 
-			u, _ = filename.split('.')
+	return metadata_by_uuid
 
-			raw_metadata = subprocess.getoutput(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "cat .local/share/remarkable/xochitl/{u}.metadata"')
 
-			try:
-				metadata = json.loads(raw_metadata)
-			except json.decoder.JSONDecodeError:
-				continue
+metadata_by_uuid = retrieve_metadata()
 
-			if metadata is not None and metadata['parent'] == '':
-				uuid_candidates.append(u)
+# index the toplevel documents by name once, that's where resync pushed them to
+toplevel_uuids_by_name = {}
+for u, metadata in metadata_by_uuid.items():
+	if metadata.get('parent') == '':
+		toplevel_uuids_by_name.setdefault(metadata.get('visibleName'), []).append(u)
 
+
+def get_uuid_by_visibleName(name):
+	"""
+	retrieves uuid for all given documents that have the given name set as visibleName
+	"""
+	uuid_candidates = toplevel_uuids_by_name.get(name, [])
 	if len(uuid_candidates) > 1:
-		print("Document {name} was found multiple times, not cleaning it up, delete manually")
+		print(f"Document {name} was found multiple times, not cleaning it up, delete manually")
 	elif len(uuid_candidates) < 1:
-		print("Document {name} was not found, unable to clean it up")
+		print(f"Document {name} was not found, unable to clean it up")
 	else:
 		return uuid_candidates[0]
 
 	return None
 
 
-for tf in targetfiles:
-	u = get_uuid_by_visibleName(tf)
-	if u is not None:
-		cmd = f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "rm -r ~/.local/share/remarkable/xochitl/{u}*"'
-		subprocess.call(cmd, shell=True)
+uuids = [get_uuid_by_visibleName(tf) for tf in targetfiles]
+patterns = ' '.join(f'{u}*' for u in uuids if u is not None)
 
-subprocess.call(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} systemctl restart xochitl', shell=True)
-ssh_connection.terminate()
+# removal and restart share a single ssh call
+remote_cmd = 'systemctl restart xochitl'
+if patterns != '':
+	remote_cmd = f'(cd ~/.local/share/remarkable/xochitl && rm -r {patterns}); {remote_cmd}'
+subprocess.call(ssh_command + [remote_cmd])
 print("All documents processed, have fun with your remaining paperwork. :)")
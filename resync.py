@@ -10,13 +10,19 @@ import uuid
 import subprocess
 import tempfile
 import pathlib
-import urllib.request
+import http.client
+import threading
 import re
+import tarfile
+import concurrent.futures
+import collections
+import hashlib
+import shlex
 
-default_prepdir = tempfile.mkdtemp(prefix="resync-")
-
-ssh_socketfile = '/tmp/remarkable-push.socket'
-ssh_options="-o BatchMode=yes"
+# the master connection is kept alive for a minute after use, so subsequent invocations
+# can reuse it; the socket lives in ~/.ssh to keep it out of reach of other users
+ssh_socketfile = '~/.ssh/remarkable-%r@%h:%p'
+ssh_options = f'-o BatchMode=yes -o ConnectTimeout=1 -o ControlMaster=auto -o ControlPersist=60 -o ControlPath={ssh_socketfile}'
 
 parser = argparse.ArgumentParser(description='Push and pull files to and from your reMarkable')
 
@@ -29,7 +35,7 @@ parser.add_argument('--if-exists', dest='conflict_behavior', choices=["skip", "n
 parser.add_argument('-e', '--exclude', dest='exclude_patterns', action='append', type=str, help='exclude a pattern from transfer (must be Python-regex)')
 
 parser.add_argument('-r', '--remote-address', action='store', default='10.11.99.1', dest='ssh_destination', metavar='<IP or hostname>', help='remote address of the reMarkable')
-parser.add_argument('--transfer-dir', metavar='<directory name>', dest='prepdir', type=str, default=default_prepdir, help='custom directory to render files to-be-upload')
+parser.add_argument('--transfer-dir', metavar='<directory name>', dest='prepdir', type=str, default=None, help='custom directory to render files to-be-upload')
 parser.add_argument('--debug', dest='debug', action='store_true', default=False, help="Render documents, but don't copy to remarkable.")
 
 parser.add_argument('mode', metavar='mode', type=str, help='push/+, pull/- or backup')
@@ -40,11 +46,27 @@ args = parser.parse_args()
 if args.exclude_patterns is None:
 	args.exclude_patterns = []
 
+# compile the exclude patterns once up front (which also reports invalid ones right away); each one
+# on its own, as inline flags and backreferences wouldn't survive being joined into one regex
+exclude_res = [re.compile(exc) for exc in args.exclude_patterns]
+
+# remote commands are handed to ssh as argv, so no local shell is spawned in between
+ssh_command = ['ssh'] + ssh_options.split() + [f'root@{args.ssh_destination}']
+
+# all documents rendered during one run share the same modification time
+run_timestamp = str(int(time.time()*1000))
+
 if args.mode == '+':
 	args.mode = 'push'
 elif args.mode == '-':
 	args.mode = 'pull'
 
+# transfer directory created by ourselves if none was given, which gets removed after
+# the run, and a user-supplied one we rendered into, which only gets emptied again;
+# see push_to_remarkable()
+temporary_prepdir = None
+supplied_prepdir = None
+
 
 class FileCollision(Exception):
 	pass
@@ -52,6 +74,9 @@ class FileCollision(Exception):
 class ShouldNeverHappenError(Exception):
 	pass
 
+class DownloadError(Exception):
+	pass
+
 
 #########################
 #
@@ -81,102 +106,178 @@ def gen_did():
 	"""
 	generates a uuid according to necessities (and marks it if desired for debugging and such)
 	"""
-	did = str(uuid.uuid4())
-	# did =  'f'*8 + did[8:]  # for debugging purposes
-	return did
+	h = uuid.uuid4().hex
+	# h = 'f'*8 + h[8:]  # for debugging purposes
+	return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+
+# metadata every folder gets when pushed, only name and parent differ
+folder_metadata_template = {
+	"visibleName": "",
+	"parent": "",
+	"lastModified": run_timestamp,
+	"metadatamodified": False,
+	"modified": False,
+	"pinned": False,
+	"synced": False,
+	"type": "CollectionType",
+	"version": 0,
+	"deleted": False,
+}
+
+# pdfs & epubs additionally carry information about when and where they were last opened
+document_metadata_template = dict(folder_metadata_template, type="DocumentType", lastOpened=run_timestamp, lastOpenedPage=0)
 
 
 def construct_metadata(filetype, name, parent_id=''):
 	"""
 	constructs a metadata-json for a specified document
 	"""
-	meta={
-		"visibleName": name,
-		"parent": parent_id,
-		"lastModified": str(int(time.time()*1000)),
-		"metadatamodified": False,
-		"modified": False,
-		"pinned": False,
-		"synced": False,
-		"type": "CollectionType",
-		"version": 0,
-		"deleted": False,
-	}
-
 	if filetype in ['pdf', 'epub']:
-		# changed from default
-		meta["type"] = "DocumentType"
+		meta = document_metadata_template.copy()
+	else:
+		meta = folder_metadata_template.copy()
 
-		# only for pdfs & epubs
-		meta["lastOpened"] = meta["lastModified"]
-		meta["lastOpenedPage"] = 0
+	meta["visibleName"] = name
+	meta["parent"] = parent_id
 
 	return meta
 
 
-def get_metadata_by_uuid(u):
+# metadata of all usable documents on the device as (uuid, metadata) pairs, keyed
+# by visibleName and by parent (toplevel documents have parent '') respectively,
+# filled by retrieve_metadata()
+metadata_by_name = collections.defaultdict(list)
+metadata_by_parent = collections.defaultdict(list)
+
+
+def retrieve_metadata():
 	"""
-	retrieves metadata for a given document identified by its uuid
+	fetches the metadata of all documents on the device in a single tar stream
+	and indexes everything that is neither deleted nor trashed by name and parent
 	"""
-	raw_metadata = subprocess.getoutput(f'ssh {ssh_options} -S {ssh_socketfile} root@{args.ssh_destination} "cat .local/share/remarkable/xochitl/{u}.metadata"')
+	p = subprocess.Popen(ssh_command + ['cd .local/share/remarkable/xochitl && tar cf - *.metadata 2>/dev/null'], stdout=subprocess.PIPE)
+
 	try:
-		metadata = json.loads(raw_metadata)
+		with tarfile.open(fileobj=p.stdout, mode='r|') as tar:
+			for member in tar:
+				if not member.isfile() or not member.name.endswith('.metadata'):
+					continue
 
-		if metadata.get('deleted') or metadata.get('parent') == 'trash':
-			return None
-		elif not name_is_safe(metadata['visibleName']):
-			logmsg(1, f"document/folder name {metadata['visibleName']} contains unsupported characters, ignoring")
-			return None
-		else:
-			return metadata
+				try:
+					metadata = json.loads(tar.extractfile(member).read().decode('utf-8'))
+				except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+					continue
 
-	except json.decoder.JSONDecodeError:
-		return None
+				if metadata.get('deleted') or metadata.get('parent') == 'trash':
+					continue
+				elif not name_is_safe(metadata.get('visibleName', '')):
+					logmsg(1, f"document/folder name {metadata['visibleName']} contains unsupported characters, ignoring")
+					continue
+
+				u = member.name[:-len('.metadata')]
+				metadata_by_name[metadata['visibleName']].append((u, metadata))
+				metadata_by_parent[metadata.get('parent', '')].append((u, metadata))
+
+	except tarfile.ReadError:
+		# empty stream, i.e. there are no documents on the device at all
+		pass
+
+	p.communicate()
 
 
 def get_metadata_by_visibleName(name):
 	"""
 	retrieves metadata for all given documents that have the given name set as visibleName
 	"""
-	cmd = f'ssh {ssh_options} -S {ssh_socketfile} root@{args.ssh_destination} "grep -lF \'\\"visibleName\\": \\"{name}\\"\' .local/share/remarkable/xochitl/*.metadata"'
-	res = subprocess.getoutput(cmd)
+	return metadata_by_name.get(name, [])
+
+
+# .content of a freshly pushed document, xochitl fills in the rest itself
+empty_content = b'{}'
+
+
+def write_bytes(path, data):
+	"""
+	writes data to a new file at path with a single unbuffered write
+	"""
+	fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+	try:
+		os.write(fd, data)
+	finally:
+		os.close(fd)
 
-	reslist = []
-	if res != '':
-		for result in res.split('\n'):
 
-			# hard pattern matching to provoke a mismatch-exception on the first number mismatch
+def copy_document(src, dst):
+	"""
+	copies a document, letting the kernel move the data directly where possible
+	(which also allows for reflinks on filesystems supporting them)
+	"""
+	# never write into an existing file, it might be an alias of the user's original
+	with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+		if hasattr(os, 'copy_file_range'):
 			try:
-				_, _, _, _, filename = result.split('/')
-			except ValueError:
-				continue
+				# some filesystems report 0 bytes copied rather than failing, so only rely
+				# on copy_file_range if it actually copied something on the first call
+				if os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30) > 0:
+					while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30) > 0:
+						pass
+					return
+			except OSError:
+				# not supported across these filesystems, continue the copy in userspace
+				pass
+
+		shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
 
-			u, _ = filename.split('.')
+# every download thread keeps its own connection to the web interface open
+download_connections = threading.local()
 
-			metadata = get_metadata_by_uuid(u)
-			if metadata is not None:
-				reslist.append((u, metadata))
 
-	return reslist
+def request_download(u):
+	"""
+	requests the document with the given uuid from the web interface, reusing this
+	thread's connection and reconnecting if the device has closed it in the meantime
+	"""
+	conn = getattr(download_connections, 'conn', None)
+	if conn is not None:
+		try:
+			conn.request('GET', f'/download/{u}/placeholder')
+			return conn.getresponse()
+		except (http.client.HTTPException, ConnectionError):
+			conn.close()
+
+	conn = download_connections.conn = http.client.HTTPConnection(args.ssh_destination)
+	conn.request('GET', f'/download/{u}/placeholder')
+	return conn.getresponse()
 
 
-def curb_tree(node, excludelist):
+def download_document(u, filename):
 	"""
-	removes nodes from a tree based on a list of exclude patterns;
-	returns True if the root node is removed, None otherwise as the
-	tree is curbed inplace
+	downloads the document with the given uuid as pdf via the web interface;
+	raises DownloadError if the web interface cannot deliver it
 	"""
-	for exc in excludelist:
-		if re.match(exc, node.get_full_path()) is not None:
-			logmsg(2, "curbing "+node.get_full_path())
-			return True
+	try:
+		resp = request_download(u)
+	except (http.client.HTTPException, OSError) as e:
+		raise DownloadError(f"{e}: Is the web interface enabled? (Settings > Storage > USB web interface)")
+
+	if resp.status != 200:
+		raise DownloadError(f"{resp.reason}: Is the web interface enabled? (Settings > Storage > USB web interface)")
 
-	uncurbed_children = []
-	for ch in node.children:
-		if not curb_tree(ch, excludelist):
-			uncurbed_children.append(ch)
+	# stream to disk, documents can be far too large to comfortably hold in memory
+	with open(filename, 'wb') as f:
+		shutil.copyfileobj(resp, f, 1 << 20)
 
-	node.children = uncurbed_children
+
+def is_excluded(node, exclude_res):
+	"""
+	checks whether the full path of a node matches any of the compiled exclude patterns
+	"""
+	path = node.get_full_path()
+	if any(r.match(path) is not None for r in exclude_res):
+		logmsg(2, "curbing "+path)
+		return True
 
 	return False
 
@@ -190,13 +291,14 @@ def curb_tree(node, excludelist):
 
 class Node:
 
-	def __init__(self, name, parent=None, filetype=None, document=None):
+	def __init__(self, name, parent=None, filetype=None, document=None, skip_lookup=False):
 
 		self.name = name
 		self.filetype = filetype
 		self.doctype = 'CollectionType' if filetype == 'folder' else 'DocumentType'
 		self.parent = parent
 		self.children = []
+		self.full_path = None
 		if filetype in ['pdf', 'epub']:
 			if document is not None:
 				self.doc = document
@@ -207,6 +309,15 @@ class Node:
 		self.exists = False
 		self.gets_modified = False
 
+		if skip_lookup:
+			# the caller already knows the document id and assigns it itself
+			return
+
+		if args.mode == 'push' and args.conflict_behavior == 'new' and self.doctype == 'DocumentType':
+			# pushed documents become new documents regardless of what is already there,
+			# so there is no point in looking them up
+			return
+
 		# now retrieve the document ID for this document if it already exists
 		metadata = get_metadata_by_visibleName(self.name)
 
@@ -227,7 +338,7 @@ class Node:
 
 			# ok, we have a document already in place at this node_point that fits the position in the document tree
 			# first, get unpack its metadata and assign the document id
-			did, md = metadata[0]
+			did, md = filtered_metadata[0]
 			self.id = did
 			self.exists = True
 
@@ -254,11 +365,27 @@ class Node:
 		self.children.append(node)
 
 
+	def walk(self):
+		"""
+		iterates over this node and all of its descendants in preorder, i.e. every
+		parent comes before its children; uses an explicit stack instead of recursion
+		"""
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			yield node
+			stack.extend(reversed(node.children))
+
+
 	def get_full_path(self):
-		if self.parent is None:
-			return self.name
-		else:
-			return self.parent.get_full_path() + '/' + self.name
+		# nodes are never renamed or moved once constructed, so this can be computed once
+		if self.full_path is None:
+			if self.parent is None:
+				self.full_path = self.name
+			else:
+				self.full_path = self.parent.get_full_path() + '/' + self.name
+
+		return self.full_path
 
 
 	def render_common(self, prepdir):
@@ -271,21 +398,21 @@ class Node:
 		if self.id is None:
 			self.id = gen_did()
 
-		with open(f'{prepdir}/{self.id}.metadata', 'w') as f:
-			if self.parent:
-				metadata = construct_metadata(self.filetype, self.name, parent_id=self.parent.id)
-			else:
-				metadata = construct_metadata(self.filetype, self.name)
-			json.dump(metadata, f, indent=4)
+		if self.parent:
+			metadata = construct_metadata(self.filetype, self.name, parent_id=self.parent.id)
+		else:
+			metadata = construct_metadata(self.filetype, self.name)
 
-		with open(f'{prepdir}/{self.id}.content', 'w') as f:
-			json.dump({}, f, indent=4)
+		# xochitl doesn't care about pretty-printing, so write compact json in one go
+		write_bytes(f'{prepdir}/{self.id}.metadata', json.dumps(metadata, separators=(',', ':')).encode('utf-8'))
+		write_bytes(f'{prepdir}/{self.id}.content', empty_content)
 
 
-	def render(self, prepdir):
+	def render(self, prepdir, copy=copy_document):
 		"""
-		This renders the given note, including DocumentType specifics;
-		needs to be reimplemented by the subclasses
+		This renders the given node (but not its children), including
+		DocumentType specifics; needs to be reimplemented by the subclasses;
+		documents are copied into prepdir via copy(src, dst)
 		"""
 		raise Exception("Rendering not implemented")
 
@@ -293,87 +420,74 @@ class Node:
 	def build_downwards(self):
 		"""
 		This creates a document tree for all nodes that are direct and indirect
-		descendants of this node.
+		descendants of this node; excluded subtrees are not built at all.
 		"""
 		if self.filetype != 'folder':
 			# documents don't have children, this one's easy
 			return
 
-		cmd = f'ssh {ssh_options} -S {ssh_socketfile} root@{args.ssh_destination} "grep -lF \'\\"parent\\": \\"{self.id}\\"\' .local/share/remarkable/xochitl/*.metadata"'
-		children_uuids = set([pathlib.Path(d).stem for d in subprocess.getoutput(cmd).split('\n')])
-		if '' in children_uuids:
-			# if we get an empty string here, there are no children to this folder
-			return
+		for chu, md in metadata_by_parent.get(self.id, []):
+			if md['type'] == "CollectionType":
+				ch = Folder(md['visibleName'], parent=self, skip_lookup=True)
+			else:
 
-		for chu in children_uuids:
-			md = get_metadata_by_uuid(chu)
-			if md is not None:
-				if md['type'] == "CollectionType":
-					ch = Folder(md['visibleName'], parent=self)
-				else:
+				name = md['visibleName']
 
-					name = md['visibleName']
+				if not name.endswith('.pdf'):
+					name += '.pdf'
 
-					if not name.endswith('.pdf'):
-						name += '.pdf'
+				ch = Document(name, parent=self, skip_lookup=True)
 
-					ch = Document(name, parent=self)
+			if is_excluded(ch, exclude_res):
+				continue
 
-				ch.id = chu
-				self.add_child(ch)
-				ch.build_downwards()
+			ch.id = chu
+			self.add_child(ch)
+			ch.build_downwards()
 
 
-	def download(self, targetdir=pathlib.Path.cwd()):
+	def download(self, targetdir, fetch):
 		"""
-		retrieve document node from the remarkable to local system
+		retrieve document node from the remarkable to local system;
+		documents are handed to fetch(uuid, path), which decides whether
+		to download them (see download_trees())
 		"""
 		if args.dryrun:
 			if self.filetype == 'folder':
 				# folders we simply create ourselves
 				print("creating directory", targetdir/self.name)
 				for ch in self.children:
-					ch.download(targetdir/self.name)
+					ch.download(targetdir/self.name, fetch=fetch)
 			else:
 				print("downloading document to", targetdir/self.name)
 		else:
 
 			logmsg(1, "retrieving " + self.get_full_path())
-			os.chdir(targetdir)
 
 			if self.filetype == 'folder':
 				# folders we simply create ourselves
-				os.makedirs(self.name, exist_ok=True)
+				os.makedirs(targetdir/self.name, exist_ok=True)
 
 				for ch in self.children:
-					ch.download(targetdir/self.name)
+					ch.download(targetdir/self.name, fetch=fetch)
 
 			else:
 				# documents we need to actually download
 				filename = self.name if self.name.lower().endswith('.pdf') else f'{self.name}.pdf'
-				if os.path.exists(filename) and args.conflict_behavior != 'replace':
-					logmsg(0, f"File {filename} already exists, skipping (use '--if-exists replace' to pull regardless)")
-				else:
-					try:
-						resp = urllib.request.urlopen(f'http://{args.ssh_destination}/download/{self.id}/placeholder')
-						with open(filename, 'wb') as f:
-							f.write(resp.read())
-					except urllib.error.URLError as e:
-						print(f"{e.reason}: Is the web interface enabled? (Settings > Storage > USB web interface)")
-						sys.exit(2)
+				fetch(self.id, targetdir/filename)
 
 
 class Document(Node):
 
-	def __init__(self, document, parent=None):
+	def __init__(self, document, parent=None, skip_lookup=False):
 
 		docpath = pathlib.Path(document)
 		filetype = docpath.suffix[1:] if docpath.suffix.startswith('.') else docpath.suffix
 
-		super().__init__(docpath.name, parent=parent, filetype=filetype, document=docpath)
+		super().__init__(docpath.name, parent=parent, filetype=filetype, document=docpath, skip_lookup=skip_lookup)
 
 
-	def render(self, prepdir):
+	def render(self, prepdir, copy=copy_document):
 		"""
 		renders an actual DocumentType tree node
 		"""
@@ -381,27 +495,25 @@ class Document(Node):
 
 			self.render_common(prepdir)
 
-			os.makedirs(f'{prepdir}/{self.id}')
-			os.makedirs(f'{prepdir}/{self.id}.thumbnails')
-			shutil.copy(self.doc, f'{prepdir}/{self.id}.{self.filetype}')
+			# prepdir itself always exists, so a plain mkdir suffices
+			os.mkdir(f'{prepdir}/{self.id}')
+			os.mkdir(f'{prepdir}/{self.id}.thumbnails')
+			copy(self.doc, f'{prepdir}/{self.id}.{self.filetype}')
 
 
 class Folder(Node):
 
-	def __init__(self, name, parent=None):
-		super().__init__(name, parent=parent, filetype='folder')
+	def __init__(self, name, parent=None, skip_lookup=False):
+		super().__init__(name, parent=parent, filetype='folder', skip_lookup=skip_lookup)
 
 
-	def render(self, prepdir):
+	def render(self, prepdir, copy=copy_document):
 		"""
 		renders a folder tree node
 		"""
 		if not self.exists:
 			self.render_common(prepdir)
 
-		for ch in self.children:
-			ch.render(prepdir)
-
 
 def identify_node(name, parent=None):
 	"""
@@ -428,17 +540,7 @@ def get_toplevel_files():
 	"""
 	get a list of all documents in the toplevel My files drawer
 	"""
-
-	cmd = f'ssh {ssh_options} -S {ssh_socketfile} root@{args.ssh_destination} "grep -lF \'\\"parent\\": \\"\\"\' .local/share/remarkable/xochitl/*.metadata"'
-	toplevel_candidates = set([pathlib.Path(d).stem for d in subprocess.getoutput(cmd).split('\n')])
-
-	toplevel_files = []
-	for u in toplevel_candidates:
-		md = get_metadata_by_uuid(u)
-		if md is not None:
-			toplevel_files.append(md['visibleName'])
-
-	return toplevel_files
+	return [md['visibleName'] for u, md in metadata_by_parent.get('', [])]
 
 
 
@@ -481,6 +583,132 @@ def upload_directly(documents):
 		sys.exit(2)
 
 
+def render_trees(roots, prepdir):
+	"""
+	renders all given document trees into prepdir; metadata is written while walking
+	the trees, the documents themselves are copied in parallel
+	"""
+	with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+		copies = []
+		copy = lambda src, dst: copies.append(executor.submit(copy_document, src, dst))
+
+		# preorder, so every folder has its id assigned before its children reference it
+		for r in roots:
+			for node in r.walk():
+				node.render(prepdir, copy=copy)
+
+		# surface any error that happened while copying
+		for c in copies:
+			c.result()
+
+
+def file_sha256(path):
+	"""
+	computes the sha256 hexdigest of a local file without reading it into memory at once
+	"""
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+
+	return h.hexdigest()
+
+
+def skip_unchanged_documents(roots):
+	"""
+	when only the underlying documents get replaced, those that are bytewise identical
+	to the ones on the device don't need to be uploaded at all; the remote checksums of
+	all candidates are computed with a single ssh call
+	"""
+	candidates = [n for r in roots for n in r.walk() if n.gets_modified]
+	if not candidates:
+		return
+
+	files = ' '.join(shlex.quote(f'{n.id}.{n.filetype}') for n in candidates)
+	output = subprocess.run(ssh_command + [f'cd .local/share/remarkable/xochitl && sha256sum {files} 2>/dev/null'], stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+	remote_checksums = {}
+	for line in output.splitlines():
+		checksum, _, filename = line.partition('  ')
+		remote_checksums[filename] = checksum
+
+	for n in candidates:
+		checksum = remote_checksums.get(f'{n.id}.{n.filetype}')
+		if checksum is not None and checksum == file_sha256(n.doc):
+			logmsg(1, f"{n.get_full_path()} is unchanged, skipping")
+			n.exists = True
+			n.gets_modified = False
+			# drop the document-only render override again, the regular one leaves existing documents alone
+			del n.render
+
+
+def download_trees(roots, targetdir):
+	"""
+	downloads all given document trees into targetdir; folders are created while
+	walking the trees, the documents themselves are downloaded in parallel
+	"""
+	# the device renders every pdf on request, so don't overwhelm it
+	with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+		downloads = []
+		failed = threading.Event()
+
+		def note_failure(d):
+			if not d.cancelled() and d.exception() is not None:
+				failed.set()
+
+		# local paths already taken by a download of this run; documents are only written once the
+		# downloads actually run, so checking the filesystem alone doesn't catch several documents
+		# ending up at the same path (e.g. equally named ones, or "Doc" and "Doc.pdf")
+		claimed = set()
+
+		def fetch(u, path):
+			if path in claimed:
+				logmsg(0, f"File {path.name} is pulled more than once, skipping all but the first")
+			elif os.path.exists(path) and args.conflict_behavior != 'replace':
+				logmsg(0, f"File {path.name} already exists, skipping (use '--if-exists replace' to pull regardless)")
+			elif not failed.is_set():
+				# once a download has failed, don't queue up any further ones
+				claimed.add(path)
+				d = executor.submit(download_document, u, path)
+				d.add_done_callback(note_failure)
+				downloads.append(d)
+
+		for r in roots:
+			r.download(targetdir=targetdir, fetch=fetch)
+
+		done, pending = concurrent.futures.wait(downloads, return_when=concurrent.futures.FIRST_EXCEPTION)
+		for d in pending:
+			d.cancel()
+
+	# surface the error that stopped the downloads, if any, once
+	try:
+		for d in done:
+			d.result()
+	except DownloadError as e:
+		print(e)
+		sys.exit(2)
+
+
+def upload_prepdir(prepdir):
+	"""
+	streams everything rendered into prepdir to the reMarkable as a single tar archive,
+	instead of having scp transfer every small file on its own, and restarts xochitl
+	afterwards within the same ssh session so it picks up the new documents
+	"""
+	def as_root(tarinfo):
+		tarinfo.uid = tarinfo.gid = 0
+		tarinfo.uname = tarinfo.gname = 'root'
+		return tarinfo
+
+	p = subprocess.Popen(ssh_command + ['tar -xf - -C .local/share/remarkable/xochitl && systemctl restart xochitl'], stdin=subprocess.PIPE)
+	# hand the data to ssh in large blocks rather than tar's default 10 KiB records
+	with tarfile.open(fileobj=p.stdin, mode='w|', format=tarfile.USTAR_FORMAT, bufsize=1 << 20) as tar:
+		for f in os.listdir(prepdir):
+			tar.add(os.path.join(prepdir, f), arcname=f, filter=as_root)
+	p.stdin.close()
+	p.wait()
+
+
 def push_to_remarkable(documents, destination=None):
 	"""
 	push a list of documents to the reMarkable
@@ -488,37 +716,47 @@ def push_to_remarkable(documents, destination=None):
 	documents: list of documents
 	destination: location on the device
 	"""
+	global temporary_prepdir, supplied_prepdir
 
 	def construct_node_tree_from_disk(basepath, parent=None):
 		"""
 		this recursively constructs the document tree based on the top-level
-		document/folder data structure on disk that we put in initially
+		document/folder data structure on disk that we put in initially;
+		returns None for files that cannot be pushed or are excluded, so
+		excluded folders are never walked in the first place
 		"""
-		path = pathlib.Path(basepath)
+		# directory entries from os.scandir already know their type, so only stat top-level paths
+		path = basepath if isinstance(basepath, os.DirEntry) else pathlib.Path(basepath)
 		if path.is_dir():
 			node = Folder(path.name, parent=parent)
-			for f in os.listdir(path):
-				child = construct_node_tree_from_disk(path/f, parent=node)
-				node.add_child(child)
-
-		elif path.is_file() and path.suffix.lower() in ['.pdf', '.epub']:
+			if is_excluded(node, exclude_res):
+				return None
+			with os.scandir(path) as entries:
+				for entry in entries:
+					child = construct_node_tree_from_disk(entry, parent=node)
+					if child is not None:
+						node.add_child(child)
+
+		elif path.is_file() and path.name.lower().endswith(('.pdf', '.epub')):
 			node = Document(path, parent=parent)
-			if node.exists:
-				if args.conflict_behavior == 'new':
-					# if we don't skip existing files, this file gets a new document ID
-					# and becomes a new file next to the existing one
-					node.id = gen_did()
-					node.exists = False
-				elif args.conflict_behavior in ['replace', 'replace-pdf-only']:
-					# ok, we want to overwrite a document. We need to pretend it's not there so it gets rendered, so let's
-					# lie to our parser here, claiming there is nothing
-					node.exists = False
-					node.gets_modified = True  # and make a note to properly mark it in case of a dry run
-					if args.conflict_behavior == 'replace-pdf-only':
-						# if we only want to overwrite the document file itself, but keep everything else,
-						# we simply switch out the render function of this node to a simple document copy
-						# might mess with xochitl's thumbnail-generation and other things, but overall seems to be fine
-						node.render = type(node.render)(lambda self, prepdir: shutil.copy(self.doc, f'{prepdir}/{self.id}.{self.filetype}'), node)
+			if is_excluded(node, exclude_res):
+				return None
+			# with 'new', existing documents are never looked up in the first place (see Node.__init__),
+			# so they get a fresh document ID and become a new file next to the existing one
+			if node.exists and args.conflict_behavior in ['replace', 'replace-pdf-only']:
+				# ok, we want to overwrite a document. We need to pretend it's not there so it gets rendered, so let's
+				# lie to our parser here, claiming there is nothing
+				node.exists = False
+				node.gets_modified = True  # and make a note to properly mark it in case of a dry run
+				if args.conflict_behavior == 'replace-pdf-only':
+					# if we only want to overwrite the document file itself, but keep everything else,
+					# we simply switch out the render function of this node to a simple document copy
+					# might mess with xochitl's thumbnail-generation and other things, but overall seems to be fine
+					node.render = type(node.render)(lambda self, prepdir, copy=copy_document: copy(self.doc, f'{prepdir}/{self.id}.{self.filetype}'), node)
+
+		else:
+			logmsg(1, f"skipping {path.name}, only pdf and epub files are supported")
+			return None
 
 		return node
 
@@ -528,18 +766,26 @@ def push_to_remarkable(documents, destination=None):
 		# into our document tree representation
 		folders = destination.split('/')
 		root = anchor = Folder(folders[0])
+		excluded = is_excluded(root, exclude_res)
 
 		for folder in folders[1:]:
 			ch = Folder(folder, parent=anchor)
 			anchor.add_child(ch)
 			anchor = ch
+			excluded = excluded or is_excluded(ch, exclude_res)
 
-		# then add the actual folders/documents to the tree at the anchor point
-		for doc in documents:
-			anchor.add_child(construct_node_tree_from_disk(doc, parent=anchor))
+		if excluded:
+			# the output directory itself is excluded, so nothing goes anywhere
+			root = []
+		else:
+			# then add the actual folders/documents to the tree at the anchor point
+			for doc in documents:
+				node = construct_node_tree_from_disk(doc, parent=anchor)
+				if node is not None:
+					anchor.add_child(node)
 
-		# make it into a 1-element list to streamline code further down
-		root = [root]
+			# make it into a 1-element list to streamline code further down
+			root = [root]
 
 	else:
 		# if no destination is supplied, make "root" a list for anchor points
@@ -548,16 +794,25 @@ def push_to_remarkable(documents, destination=None):
 		# then add the actual folders/documents to the tree as anchor points
 		# that will show up on the top-level
 		for doc in documents:
-			root.append(construct_node_tree_from_disk(doc))
-
-
-	# apply excludes
-	curbed_roots = []
-	for r in root:
-		if not curb_tree(r, args.exclude_patterns):
-			curbed_roots.append(r)
-
-	root = curbed_roots
+			node = construct_node_tree_from_disk(doc)
+			if node is not None:
+				root.append(node)
+
+
+	if args.conflict_behavior == 'replace-pdf-only':
+		skip_unchanged_documents(root)
+
+	if args.prepdir is None and not args.dryrun:
+		# only create a transfer directory now that there actually is something to render
+		args.prepdir = temporary_prepdir = tempfile.mkdtemp(prefix="resync-")
+	elif not args.dryrun:
+		# everything in the transfer directory gets uploaded, so it must not contain leftovers
+		os.makedirs(args.prepdir, exist_ok=True)
+		if os.listdir(args.prepdir):
+			print(f"Transfer directory {args.prepdir} is not empty, refusing to upload whatever is in there.", file=sys.stderr)
+			sys.exit(1)
+		if not args.debug:
+			supplied_prepdir = args.prepdir
 
 
 	if args.dryrun:
@@ -593,17 +848,14 @@ def push_to_remarkable(documents, destination=None):
 
 	elif args.debug:
 
-		for r in root:
-			r.render(args.prepdir)
+		render_trees(root, args.prepdir)
 		print(f' --> Payload data can be found in {args.prepdir}, if specified')
 
 	else:  # actually upload to the reMarkable
 
-		for r in root:
-			r.render(args.prepdir)
+		render_trees(root, args.prepdir)
 
-		subprocess.call(f'scp {ssh_options} -r {args.prepdir}/* root@{args.ssh_destination}:.local/share/remarkable/xochitl', shell=True)
-		subprocess.call(f'ssh {ssh_options} -S {ssh_socketfile} root@{args.ssh_destination} systemctl restart xochitl', shell=True)
+		upload_prepdir(args.prepdir)
 
 
 def pull_from_remarkable(documents, destination=None):
@@ -636,26 +888,24 @@ def pull_from_remarkable(documents, destination=None):
 			print(f"Cannot find {doc}, skipping")
 
 
+	roots = []
 	for a in anchors:
-		a.build_downwards()
-		if not curb_tree(a, args.exclude_patterns):
-			a.download(targetdir=destination_directory)
+		if not is_excluded(a, exclude_res):
+			a.build_downwards()
+			roots.append(a)
 
+	download_trees(roots, destination_directory)
 
-ssh_connection = None
-try:
-	ssh_connection = subprocess.Popen(f'ssh -o ConnectTimeout=1 -M -N -q -S {ssh_socketfile} root@{args.ssh_destination}', shell=True)
 
-	# quickly check if we actually have a functional ssh connection (might not be the case right after an update)
-	p = subprocess.Popen(f'ssh {ssh_options} -S {ssh_socketfile} root@{args.ssh_destination} "/bin/true"', shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	p.wait()
-	if p.returncode != 0:
-		stdout, stderr = p.communicate()
-		print("ssh connection does not work, verify that you can manually ssh into your reMarkable. ssh itself commented the situation with:")
-		print(stdout.decode('utf-8'), stderr.decode('utf-8'))
-		ssh_connection.terminate()
+try:
+	# quickly check if we actually have a functional ssh connection (might not be the case right after an update);
+	# this call may start the persistent master connection, and older ssh clients leave that one attached to
+	# our stderr, so ssh gets to talk to the terminal directly instead of through a pipe we'd wait on
+	if subprocess.run(ssh_command + ['/bin/true']).returncode != 0:
+		print("ssh connection does not work, verify that you can manually ssh into your reMarkable. ssh itself commented the situation above.")
 		sys.exit(255)
 
+	retrieve_metadata()
 
 	if args.mode == 'push':
 		if args.output_destination is None and args.conflict_behavior not in ['replace', 'replace-pdf-only']:
@@ -676,8 +926,12 @@ try:
 		print("    backup: pull all files from the remarkable to this machine (excludes still apply)")
 
 finally:
-	if ssh_connection is not None:
-		ssh_connection.terminate()
-		#os.remove(ssh_socketfile)
-	if os.path.exists(default_prepdir):  # we created this
-		shutil.rmtree(args.prepdir)
+	if temporary_prepdir is not None:  # we created this
+		shutil.rmtree(temporary_prepdir)
+	elif supplied_prepdir is not None:
+		# leave the transfer directory empty for the next run
+		for entry in os.scandir(supplied_prepdir):
+			if entry.is_dir(follow_symlinks=False):
+				shutil.rmtree(entry.path)
+			else:
+				os.remove(entry.path)